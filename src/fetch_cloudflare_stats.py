@@ -1,14 +1,28 @@
 import os
+import re
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import logging
-import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 import numpy as np
 import time
+import threading
+from bisect import bisect_left
+from functools import lru_cache
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from urllib.parse import quote
 
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -17,66 +31,269 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# HTTP 请求超时（连接超时, 读取超时），避免网络异常时请求无限期挂起
+REQUEST_TIMEOUT = (5, 30)
+
+def _json_loads(data: bytes) -> Any:
+    """解析 JSON 字节串（优先使用 orjson）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+def _json_dumps(obj: Any, indent: bool = True) -> bytes:
+    """序列化为 JSON 字节串（优先使用 orjson），indent 为 True 时缩进并按键排序"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if indent else None)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Telegram Markdown（旧版）中需要转义的字符
+_MARKDOWN_SPECIAL = re.compile(r'([_*`\[])')
+
+def _escape_markdown(text: str) -> str:
+    """转义 Markdown 特殊字符，用于粗体等格式之外的名称"""
+    return _MARKDOWN_SPECIAL.sub(r'\\\1', text)
+
+# Cloudflare 项目名和 Worker 名通常只包含这些字符，无需 URL 编码
+_SAFE_NAME = re.compile(r'[A-Za-z0-9_\-]+')
+
+@lru_cache(maxsize=None)
+def _encode_name(name: str) -> str:
+    """对项目名/Worker 名做 URL 编码，常见的安全名称直接返回，结果按名称缓存"""
+    return name if _SAFE_NAME.fullmatch(name) else quote(name, safe='')
+
+# 从指标响应中提取请求量
+_get_requests = itemgetter("requests")
+_get_script = itemgetter("script")
+
+class TokenBucket:
+    """线程安全的令牌桶限流器"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate  # 每秒补充的令牌数
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """取走一个令牌，令牌不足时阻塞等待"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# 按 Worker 汇总请求量的 GraphQL 查询，一次请求即可得到账户下所有 Worker 的数据
+WORKERS_REQUESTS_QUERY = """
+query ($accountTag: string!, $since: Time!, $until: Time!) {
+  viewer {
+    accounts(filter: {accountTag: $accountTag}) {
+      workersInvocationsAdaptive(limit: 10000, filter: {datetime_geq: $since, datetime_lt: $until}) {
+        sum { requests }
+        dimensions { scriptName }
+      }
+    }
+  }
+}
+"""
+
 class CloudflareAPI:
     """与 Cloudflare API 交互的类"""
     
-    def __init__(self, account_id: str, api_token: str):
+    # 磁盘缓存默认有效期（秒）：项目列表很少变化，指标数据只在短时间内复用；可通过环境变量调整，设为 0 时不使用缓存
+    LIST_CACHE_TTL = 3600
+    METRICS_CACHE_TTL = 300
+    
+    def __init__(self, account_id: str, api_token: str, cache_dir: Optional[str] = None,
+                 max_attempts: int = 3, retry_delay: int = 1, retry_max_delay: int = 30,
+                 max_concurrency: int = 16, rate_limit: int = 1200,
+                 session: Optional[requests.Session] = None,
+                 list_cache_ttl: Optional[int] = None, metrics_cache_ttl: Optional[int] = None):
         self.account_id = account_id
         self.api_token = api_token
         self.base_url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}"
+        self.pages_projects_url = f"{self.base_url}/pages/projects"
+        self.pages_metrics_url_template = self.pages_projects_url + "/{project_name}/metrics"
+        self.workers_url = f"{self.base_url}/workers/scripts"
+        self.workers_analytics_url = f"{self.base_url}/workers/analytics/dashboard"
+        self.graphql_url = "https://api.cloudflare.com/client/v4/graphql"
         self.headers = {
             "Authorization": f"Bearer {api_token}",
             "Content-Type": "application/json"
         }
+        # 复用连接池，避免每次请求重新建立 TCP/TLS 连接；会话可与 TelegramBot 共用，
+        # 因此认证头随每个请求单独发送，连接池只挂载到 Cloudflare API 的地址上；
+        # 限流和服务端错误由 urllib3 按指数退避自动重试（并遵循 Retry-After），
+        # 退避时间加入随机抖动并设置上限，避免并发请求同时重试或单次等待过久
+        retry = Retry(
+            total=max(max_attempts - 1, 0),
+            backoff_factor=retry_delay,
+            backoff_jitter=retry_delay,
+            backoff_max=retry_max_delay,
+            status_forcelist=(429, 500, 502, 503, 504)
+        )
+        self.session = session or requests.Session()
+        self.session.mount("https://api.cloudflare.com/",
+                           HTTPAdapter(pool_maxsize=max_concurrency, max_retries=retry))
+        self.cache_dir = cache_dir
+        self.list_cache_ttl = self.LIST_CACHE_TTL if list_cache_ttl is None else list_cache_ttl
+        self.metrics_cache_ttl = self.METRICS_CACHE_TTL if metrics_cache_ttl is None else metrics_cache_ttl
+        # 本次运行内已成功获取的响应，重复请求时直接复用
+        self._memo: Dict[str, Dict[str, Any]] = {}
+        # Cloudflare API 限制为每 5 分钟 rate_limit 次请求：任意 5 分钟内最多发出
+        # 初始的 burst 个请求加上补充的 rate_limit - burst 个请求，合计不超过 rate_limit
+        burst = max(min(max_concurrency, rate_limit // 2), 1)
+        self.rate_limiter = TokenBucket(rate=max(rate_limit - burst, 1) / 300, capacity=burst)
     
-    def fetch_pages_projects(self) -> List[Dict[str, Any]]:
+    def _cache_path(self, cache_key: str) -> str:
+        digest = hashlib.sha1(f"{self.account_id}:{cache_key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+    
+    def _read_cache(self, cache_path: str, ttl: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """读取磁盘缓存，指定 ttl 时只返回未过期的缓存"""
+        try:
+            if ttl is None or os.path.getmtime(cache_path) > time.time() - ttl:
+                with open(cache_path, 'rb') as f:
+                    return _json_loads(f.read())
+        except (OSError, ValueError):
+            pass
+        return None
+    
+    @staticmethod
+    def _read_etag(cache_path: str) -> Optional[str]:
         try:
-            url = f"{self.base_url}/pages/projects"
-            response = requests.get(url, headers=self.headers)
+            with open(f"{cache_path}.etag", 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+    
+    def _write_cache(self, cache_path: str, response: requests.Response) -> None:
+        """写入响应缓存及其 ETag；304 响应只刷新缓存的有效期"""
+        try:
+            if response.status_code == 304:
+                os.utime(cache_path)
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(tmp_path, cache_path)
+            etag = response.headers.get("ETag")
+            if etag:
+                with open(f"{cache_path}.etag", 'w', encoding='utf-8') as f:
+                    f.write(etag)
+            elif os.path.exists(f"{cache_path}.etag"):
+                os.remove(f"{cache_path}.etag")
+        except OSError as e:
+            logger.warning(f"写入缓存失败: {str(e)}")
+    
+    def _request(self, url: str, params: Optional[Dict[str, str]] = None,
+                 cache_key: Optional[str] = None, ttl: int = 0,
+                 stale_on_error: bool = False, json_body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """发送 GET 请求（指定 json_body 时为 POST），优先使用未过期的缓存；stale_on_error 时请求失败退回过期缓存"""
+        if cache_key in self._memo:
+            return self._memo[cache_key]
+        
+        cache_path = self._cache_path(cache_key) if self.cache_dir and cache_key and ttl > 0 else None
+        payload = self._read_cache(cache_path, ttl) if cache_path else None
+        if payload is not None:
+            return payload
+        
+        # 过期的缓存带上 ETag 重新验证，内容未变化时服务端只返回 304，无需重新传输和解析
+        headers = self.headers
+        etag = self._read_etag(cache_path) if cache_path else None
+        if etag:
+            headers = {**self.headers, "If-None-Match": etag}
+        
+        try:
+            self.rate_limiter.acquire()
+            response = self.session.request("GET" if json_body is None else "POST", url, params=params,
+                                            json=json_body, headers=headers, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
-            return response.json()["result"]
+            if response.status_code == 304:
+                payload = self._read_cache(cache_path)
+                if payload is None:
+                    raise ValueError("服务端返回 304，但本地缓存不可用")
+            else:
+                payload = _json_loads(response.content)
+        except Exception as e:
+            payload = self._read_cache(cache_path) if cache_path and stale_on_error else None
+            if payload is None:
+                raise
+            logger.warning(f"请求失败，使用过期的缓存数据: {str(e)}")
+            return payload
+        
+        if cache_path:
+            self._write_cache(cache_path, response)
+        if cache_key:
+            self._memo[cache_key] = payload
+        return payload
+    
+    def fetch_pages_projects(self) -> List[Dict[str, Any]]:
+        try:
+            return self._request(self.pages_projects_url, cache_key="pages_projects",
+                                 ttl=self.list_cache_ttl, stale_on_error=True)["result"]
         except Exception as e:
             logger.error(f"获取 Pages 项目失败: {str(e)}")
             return []
     
     def fetch_workers(self) -> List[Dict[str, Any]]:
         try:
-            url = f"{self.base_url}/workers/scripts"
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
-            return response.json()["result"]
+            return self._request(self.workers_url, cache_key="workers",
+                                 ttl=self.list_cache_ttl, stale_on_error=True)["result"]
         except Exception as e:
             logger.error(f"获取 Workers 失败: {str(e)}")
             return []
     
     def fetch_pages_metrics(self, project_name: str, start: str, end: str) -> Dict[str, Any]:
         try:
-            encoded_project_name = quote(project_name, safe='')
-            url = f"{self.base_url}/pages/projects/{encoded_project_name}/metrics"
+            url = self.pages_metrics_url_template.format(project_name=_encode_name(project_name))
             params = {
                 "since": start,
                 "until": end,
                 "continuous": "true"
             }
-            response = requests.get(url, headers=self.headers, params=params)
-            response.raise_for_status()
-            return response.json()["result"]
+            return self._request(url, params=params, cache_key=f"pages_metrics:{project_name}",
+                                 ttl=self.metrics_cache_ttl)["result"]
         except Exception as e:
             logger.error(f"获取 Pages 指标失败: {str(e)}")
             return {}
     
+    def fetch_all_workers_requests(self, start: str, end: str) -> Optional[Dict[str, int]]:
+        """通过 GraphQL Analytics API 一次查询账户下所有 Worker 的请求量，失败时返回 None"""
+        try:
+            payload = self._request(self.graphql_url, json_body={
+                "query": WORKERS_REQUESTS_QUERY,
+                "variables": {"accountTag": self.account_id, "since": start, "until": end}
+            })
+            if payload.get("errors"):
+                raise ValueError(payload["errors"][0].get("message"))
+            requests_by_script: Dict[str, int] = {}
+            for group in payload["data"]["viewer"]["accounts"][0]["workersInvocationsAdaptive"]:
+                script_name = group["dimensions"]["scriptName"]
+                requests_by_script[script_name] = requests_by_script.get(script_name, 0) + group["sum"]["requests"]
+            return requests_by_script
+        except Exception as e:
+            logger.warning(f"GraphQL 批量获取 Workers 请求量失败，改为逐个查询: {str(e)}")
+            return None
+    
     def fetch_workers_metrics(self, script_name: str, start: str, end: str) -> Dict[str, Any]:
         try:
-            encoded_script_name = quote(script_name, safe='')
-            url = f"{self.base_url}/workers/analytics/dashboard"
             params = {
-                "script_name": encoded_script_name,
+                "script_name": _encode_name(script_name),
                 "since": start,
                 "until": end
             }
-            response = requests.get(url, headers=self.headers, params=params)
-            response.raise_for_status()
-            return response.json()["result"]
+            return self._request(self.workers_analytics_url, params=params,
+                                 cache_key=f"workers_metrics:{script_name}",
+                                 ttl=self.metrics_cache_ttl)["result"]
         except Exception as e:
             logger.error(f"获取 Workers 指标失败: {str(e)}")
             return {}
@@ -84,23 +301,33 @@ class CloudflareAPI:
 class TelegramBot:
     """与 Telegram Bot API 交互的类"""
     
-    def __init__(self, bot_token: str, chat_id: str):
+    # 文本消息和图片说明的长度上限（按 UTF-16 码元计）
+    MESSAGE_LIMIT = 4096
+    CAPTION_LIMIT = 1024
+    # 通过上传方式发送图片的文件大小上限
+    PHOTO_SIZE_LIMIT = 10 * 1024 * 1024
+    
+    def __init__(self, bot_token: str, chat_id: str, session: Optional[requests.Session] = None):
         self.bot_token = bot_token
         self.chat_id = chat_id
         self.base_url = f"https://api.telegram.org/bot{bot_token}"
+        self.session = session or requests.Session()
+        self.session.mount("https://api.telegram.org/", HTTPAdapter(pool_connections=1, pool_maxsize=4))
         logger.info(f"Telegram Bot Token 验证: {bot_token[:5] + '...'}")
     
     def send_message(self, message: str) -> bool:
         try:
             url = f"{self.base_url}/sendMessage"
-            data = {
-                "chat_id": self.chat_id,
-                "text": message,
-                "parse_mode": "Markdown",
-                "disable_web_page_preview": True
-            }
-            response = requests.post(url, json=data)
-            response.raise_for_status()
+            # 超过长度上限的消息按行拆分，依次发送
+            for chunk in self.split_message(message):
+                data = {
+                    "chat_id": self.chat_id,
+                    "text": chunk,
+                    "parse_mode": "Markdown",
+                    "disable_web_page_preview": True
+                }
+                response = self.session.post(url, json=data, timeout=REQUEST_TIMEOUT)
+                response.raise_for_status()
             return True
         except Exception as e:
             logger.error(f"发送 Telegram 消息失败: {str(e)}")
@@ -109,18 +336,148 @@ class TelegramBot:
     def send_photo(self, photo_path: str, caption: str = "") -> bool:
         try:
             url = f"{self.base_url}/sendPhoto"
-            files = {'photo': open(photo_path, 'rb')}
             data = {
                 "chat_id": self.chat_id,
                 "caption": caption,
                 "parse_mode": "Markdown"
             }
-            response = requests.post(url, files=files, data=data)
+            with open(photo_path, 'rb') as photo:
+                response = self.session.post(url, files={'photo': photo}, data=data, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
             return True
         except Exception as e:
             logger.error(f"发送 Telegram 图片失败: {str(e)}")
             return False
+    
+    def send_media_group(self, photos: List[Tuple[str, str]]) -> bool:
+        """以相册形式一次性发送多张图片（2~10 张），photos 为 (图片路径, 说明) 列表"""
+        try:
+            url = f"{self.base_url}/sendMediaGroup"
+            media = [
+                {"type": "photo", "media": f"attach://photo{i}", "caption": caption, "parse_mode": "Markdown"}
+                for i, (_, caption) in enumerate(photos)
+            ]
+            with ExitStack() as stack:
+                files = {
+                    f"photo{i}": stack.enter_context(open(photo_path, 'rb'))
+                    for i, (photo_path, _) in enumerate(photos)
+                }
+                data = {
+                    "chat_id": self.chat_id,
+                    "media": _json_dumps(media, indent=False).decode('utf-8')
+                }
+                response = self.session.post(url, files=files, data=data, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            logger.error(f"发送 Telegram 图片组失败: {str(e)}")
+            return False
+    
+    def send_photos(self, photos: List[Tuple[str, str]]) -> bool:
+        """发送若干张图片，多张时合并为一次 sendMediaGroup 请求"""
+        if len(photos) > 1:
+            return self.send_media_group(photos)
+        if photos:
+            return self.send_photo(*photos[0])
+        return True
+    
+    @classmethod
+    def can_upload(cls, photo_path: str) -> bool:
+        """检查图片文件是否存在且大小在 Telegram 的限制范围内"""
+        try:
+            size = os.stat(photo_path).st_size
+        except OSError as e:
+            logger.warning(f"图片文件不可用: {str(e)}")
+            return False
+        if size == 0 or size > cls.PHOTO_SIZE_LIMIT:
+            logger.warning(f"图片大小不符合要求，跳过发送: {photo_path} ({size} 字节)")
+            return False
+        return True
+    
+    @staticmethod
+    def _text_length(text: str) -> int:
+        """Telegram 按 UTF-16 码元计算文本长度"""
+        return len(text.encode('utf-16-le')) // 2
+    
+    @classmethod
+    def fits_caption(cls, text: str) -> bool:
+        """判断文本能否作为图片说明发送"""
+        return cls._text_length(text) <= cls.CAPTION_LIMIT
+    
+    @classmethod
+    def split_message(cls, text: str) -> List[str]:
+        """按行将文本拆分为不超过消息长度上限的若干段，避免拆开同一行内的 Markdown 格式"""
+        chunks = []
+        lines = []
+        size = -1
+        for line in text.split("\n"):
+            length = cls._text_length(line) + 1
+            if lines and size + length > cls.MESSAGE_LIMIT:
+                chunks.append("\n".join(lines))
+                lines = []
+                size = -1
+            lines.append(line)
+            size += length
+        chunks.append("\n".join(lines))
+        return chunks
+
+# 趋势图配置: (数据类别, 图表标题, 图片路径, Telegram 图片说明)
+CHART_SPECS = [
+    ("pages", "Cloudflare Pages 项目请求量趋势", "pages_trend.png", "📄 Cloudflare Pages 项目请求量趋势图"),
+    ("workers", "Cloudflare Workers 服务请求量趋势", "workers_trend.png", "💻 Cloudflare Workers 服务请求量趋势图"),
+]
+
+@lru_cache(maxsize=None)
+def _get_pyplot():
+    """首次绘图时才导入 matplotlib，不生成图表的运行无需承担其导入和字体扫描的开销"""
+    import matplotlib
+    matplotlib.use("Agg")  # 无界面环境下直接使用 Agg 后端，跳过 GUI 后端探测
+    import matplotlib.pyplot as plt
+    # 图表中文字体配置，设置一次即可
+    plt.rcParams["font.family"] = ["SimHei", "WenQuanYi Micro Hei", "Heiti TC"]
+    plt.rcParams["axes.unicode_minus"] = False
+    return plt
+
+def _plot_trend(ax, history: Dict[str, Any], title: str) -> None:
+    """在给定坐标轴上绘制请求量趋势图"""
+    import matplotlib.dates as mdates
+    ax.clear()
+    # 日期预先解析为 datetime64，避免 matplotlib 逐个处理字符串，并得到真正的时间轴
+    dates = np.array(history["dates"], dtype="datetime64[D]")
+    # 数据点过多时不绘制圆点标记，标记的绘制开销远大于折线本身
+    marker = 'o' if len(dates) <= 200 else None
+    for name, values in history["series"].items():
+        # 缺失的日期为 None，转换为 NaN 后在折线上显示为断点
+        requests = np.array(values, dtype=np.float64)
+        if np.count_nonzero(~np.isnan(requests)) > 1:
+            ax.plot(dates, requests, marker=marker, label=name)
+    ax.set_title(title)
+    ax.set_xlabel("日期")
+    ax.set_ylabel("请求量")
+    ax.grid(True)
+    ax.legend()
+    # 按天显示刻度，日期较多时自动隔天显示，避免标签重叠
+    ax.xaxis.set_major_locator(mdates.DayLocator(interval=max(len(dates) // 15, 1)))
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+    ax.tick_params(axis='x', labelrotation=45)
+
+def render_trend_charts(history_data: Dict[str, Any]) -> List[str]:
+    """根据历史数据渲染趋势图，返回生成的图片路径"""
+    charts = []
+    plt = _get_pyplot()
+    # 所有图表复用同一个 Figure/Axes，避免重复创建和销毁
+    fig, ax = plt.subplots(figsize=(12, 6))
+    try:
+        for kind, title, chart_path, _ in CHART_SPECS:
+            if not history_data[kind]["series"]:
+                continue
+            _plot_trend(ax, history_data[kind], title)
+            fig.tight_layout()
+            fig.savefig(chart_path, dpi=80)
+            charts.append(chart_path)
+    finally:
+        plt.close(fig)
+    return charts
 
 class CloudflareStatsTracker:
     """Cloudflare 统计数据跟踪器"""
@@ -139,52 +496,115 @@ class CloudflareStatsTracker:
             self._load_config(config_path)
         
         # 初始化 API 客户端
-        self.cf_api = CloudflareAPI(self.cf_account_id, self.cf_api_token)
-        self.tg_bot = TelegramBot(self.tg_bot_token, self.tg_chat_id)
+        self.retry_config = self._get_retry_config()
+        # 同时进行的 Cloudflare 请求数上限，避免触发 429 限流
+        self.fetch_concurrency = max(int(os.getenv("FETCH_CONCURRENCY", 16)), 1)
+        cache_dir = os.getenv("CACHE_DIR", ".cache")
+        # Cloudflare 与 Telegram 客户端共用一个会话，运行结束时统一关闭
+        self.session = requests.Session()
+        self.cf_api = CloudflareAPI(self.cf_account_id, self.cf_api_token,
+                                    cache_dir=cache_dir,
+                                    max_attempts=self.retry_config["max_attempts"],
+                                    retry_delay=self.retry_config["delay"],
+                                    retry_max_delay=self.retry_config["max_delay"],
+                                    max_concurrency=self.fetch_concurrency,
+                                    rate_limit=max(int(os.getenv("CF_RATE_LIMIT", 1200)), 1),
+                                    session=self.session,
+                                    list_cache_ttl=int(os.getenv("LIST_CACHE_TTL", CloudflareAPI.LIST_CACHE_TTL)),
+                                    metrics_cache_ttl=int(os.getenv("METRICS_CACHE_TTL", CloudflareAPI.METRICS_CACHE_TTL)))
+        self.tg_bot = TelegramBot(self.tg_bot_token, self.tg_chat_id, session=self.session)
+        
+        # 本次运行的时间基准，各方法共用，避免运行跨越零点时日期不一致
+        self.run_time = datetime.now()
+        self.today = self.run_time.strftime("%Y-%m-%d")
+        self.yesterday = (self.run_time - timedelta(days=1)).strftime("%Y-%m-%d")
         
         # 初始化数据存储
         self.current_data = {"pages": {}, "workers": {}}
+        self.history_file = os.getenv("HISTORY_FILE", "history/history.json")
+        # 已加载的历史文件内容摘要，保存时内容未变化则跳过写入
+        self._history_digest: Optional[bytes] = None
         self.history_data = self._load_history()
         self.thresholds = self._get_thresholds()
-        self.retry_config = self._get_retry_config()
+    
+    def __enter__(self) -> "CloudflareStatsTracker":
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.session.close()
     
     def _load_config(self, config_path: str) -> None:
         """从配置文件加载非敏感配置（备用方案）"""
         try:
             if os.path.exists(config_path):
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
+                with open(config_path, 'rb') as f:
+                    config = _json_loads(f.read())
                 
                 # 从配置文件读取备用配置
-                self.cf_account_id = self.cf_account_id or config.get("cloudflare", {}).get("account_id")
-                self.cf_api_token = self.cf_api_token or config.get("cloudflare", {}).get("api_token")
-                self.tg_bot_token = self.tg_bot_token or config.get("telegram", {}).get("bot_token")
-                self.tg_chat_id = self.tg_chat_id or config.get("telegram", {}).get("chat_id")
+                cf_config = config.get("cloudflare", {})
+                tg_config = config.get("telegram", {})
+                self.cf_account_id = self.cf_account_id or cf_config.get("account_id")
+                self.cf_api_token = self.cf_api_token or cf_config.get("api_token")
+                self.tg_bot_token = self.tg_bot_token or tg_config.get("bot_token")
+                self.tg_chat_id = self.tg_chat_id or tg_config.get("chat_id")
         except Exception as e:
             logger.error(f"加载配置文件失败: {str(e)}")
     
+    @staticmethod
+    def _to_columns(section: Dict[str, Any]) -> Dict[str, Any]:
+        """将旧版 {名称: {日期: 请求量}} 结构转换为按列存储的 {"dates": [...], "series": {名称: [...]}}"""
+        if isinstance(section.get("dates"), list):
+            return section
+        dates = sorted({date for data in section.values() for date in data})
+        series = {name: [data.get(date) for date in dates] for name, data in section.items()}
+        return {"dates": dates, "series": series}
+    
     def _load_history(self) -> Dict[str, Any]:
         """加载历史数据"""
-        history_file = os.getenv("HISTORY_FILE", "history/history.json")
+        history_file = self.history_file
+        empty = {"pages": {"dates": [], "series": {}}, "workers": {"dates": [], "series": {}}}
         try:
-            os.makedirs(os.path.dirname(history_file), exist_ok=True)
+            os.makedirs(os.path.dirname(history_file) or ".", exist_ok=True)
             if os.path.exists(history_file):
-                with open(history_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {"pages": {}, "workers": {}}
+                with open(history_file, 'rb') as f:
+                    content = f.read()
+                self._history_digest = self._digest(content)
+                data = _json_loads(content)
+                return {kind: self._to_columns(data.get(kind, {})) for kind in ("pages", "workers")}
+            return empty
         except Exception as e:
             logger.error(f"加载历史数据失败: {str(e)}")
-            return {"pages": {}, "workers": {}}
+            return empty
+    
+    @staticmethod
+    def _digest(content: bytes) -> bytes:
+        """历史文件内容的摘要，只用于判断内容是否变化，16 字节足够"""
+        return hashlib.blake2b(content, digest_size=16).digest()
     
     def _save_history(self) -> None:
-        """保存历史数据"""
-        history_file = os.getenv("HISTORY_FILE", "history/history.json")
+        """保存历史数据（先写临时文件再原子替换，避免写入中断导致文件损坏）"""
+        history_file = self.history_file
+        tmp_file = f"{history_file}.tmp"
         try:
-            os.makedirs(os.path.dirname(history_file), exist_ok=True)
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.history_data, f, ensure_ascii=False, indent=2)
+            content = _json_dumps(self.history_data)
+            digest = self._digest(content)
+            if digest == self._history_digest:
+                logger.info("历史数据没有变化，跳过写入")
+                return
+            with open(tmp_file, 'wb') as f:
+                f.write(content)
+                # 确保数据落盘后再替换，避免断电后留下空文件
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, history_file)
+            self._history_digest = digest
         except Exception as e:
             logger.error(f"保存历史数据失败: {str(e)}")
+            # 删除残留的临时文件，避免被工作流随 history/ 一起提交
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
     
     def _get_thresholds(self) -> Dict[str, int]:
         """获取阈值配置（从环境变量或默认值）"""
@@ -199,23 +619,10 @@ class CloudflareStatsTracker:
         """获取重试配置（从环境变量或默认值）"""
         return {
             "max_attempts": int(os.getenv("RETRY_MAX_ATTEMPTS", 3)),
-            "delay": int(os.getenv("RETRY_DELAY", 1))
+            "delay": int(os.getenv("RETRY_DELAY", 1)),
+            "max_delay": int(os.getenv("RETRY_MAX_DELAY", 30))
         }
     
-    def _retry(self, func, *args, **kwargs):
-        """重试机制装饰器"""
-        max_attempts = self.retry_config["max_attempts"]
-        delay = self.retry_config["delay"]
-        
-        for attempt in range(max_attempts):
-            try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                if attempt == max_attempts - 1:
-                    raise
-                logger.warning(f"尝试 {attempt + 1}/{max_attempts} 失败: {str(e)}，{delay}秒后重试")
-                time.sleep(delay)
-    
     def fetch_stats(self) -> None:
         """获取当前统计数据"""
         end_time = datetime.utcnow()
@@ -223,185 +630,210 @@ class CloudflareStatsTracker:
         start_str = start_time.isoformat(timespec='seconds') + 'Z'
         end_str = end_time.isoformat(timespec='seconds') + 'Z'
         
-        pages_projects = self._retry(self.cf_api.fetch_pages_projects)
-        for project in pages_projects:
-            project_name = project["name"]
-            metrics = self._retry(self.cf_api.fetch_pages_metrics, project_name, start_str, end_str)
-            if metrics and "requests" in metrics:
-                self.current_data["pages"][project_name] = metrics["requests"]
-        
-        workers = self._retry(self.cf_api.fetch_workers)
-        for worker in workers:
-            # 关键修改：安全获取 worker 名称
-            worker_name = worker.get("name", f"未知Worker_{id(worker)}")
-            logger.info(f"处理 Worker: {worker_name}")  # 添加日志帮助调试
+        with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as executor:
+            # Pages 项目列表与 Workers 列表互不依赖，同时请求
+            pages_projects_future = executor.submit(self.cf_api.fetch_pages_projects)
+            workers_future = executor.submit(self.cf_api.fetch_workers)
+            # 所有 Worker 的请求量优先通过一次 GraphQL 查询获取，失败时再逐个请求
+            workers_requests_future = executor.submit(self.cf_api.fetch_all_workers_requests, start_str, end_str)
             
-            # 验证 worker 对象结构是否符合预期
-            if not isinstance(worker, dict):
-                logger.warning(f"Worker 对象不是字典类型: {type(worker)}")
-                continue
+            # 并发请求各项目/Worker 的指标，总耗时约为单次请求耗时
+            pages_futures = {}
+            for project in pages_projects_future.result():
+                project_name = project["name"]
+                pages_futures[project_name] = executor.submit(
+                    self.cf_api.fetch_pages_metrics, project_name, start_str, end_str)
+            
+            workers_requests = workers_requests_future.result()
+            workers_futures = {}
+            for worker in workers_future.result():
+                # 验证 worker 对象结构是否符合预期
+                if not isinstance(worker, dict):
+                    logger.warning(f"Worker 对象不是字典类型: {type(worker)}")
+                    continue
+                
+                # 关键修改：安全获取 worker 名称（/workers/scripts 返回的脚本名在 id 字段中）
+                worker_name = worker.get("name") or worker.get("id")
+                if not worker_name:
+                    logger.warning(f"Worker 对象缺少名称，跳过: {worker}")
+                    continue
+                logger.info(f"处理 Worker: {worker_name}")  # 添加日志帮助调试
+                if workers_requests is not None:
+                    # 统计时段内没有调用的 Worker 不会出现在查询结果中
+                    self.current_data["workers"][worker_name] = workers_requests.get(worker_name, 0)
+                    continue
+                workers_futures[worker_name] = executor.submit(
+                    self.cf_api.fetch_workers_metrics, worker_name, start_str, end_str)
             
-            metrics = self._retry(self.cf_api.fetch_workers_metrics, worker_name, start_str, end_str)
-            if metrics and "script" in metrics and "requests" in metrics["script"]:
-                self.current_data["workers"][worker_name] = metrics["script"]["requests"]
+            # 获取失败时指标为空字典，提取时抛出 KeyError，直接跳过
+            for project_name, future in pages_futures.items():
+                try:
+                    self.current_data["pages"][project_name] = _get_requests(future.result())
+                except (KeyError, TypeError):
+                    pass
+            
+            for worker_name, future in workers_futures.items():
+                try:
+                    self.current_data["workers"][worker_name] = _get_requests(_get_script(future.result()))
+                except (KeyError, TypeError):
+                    pass
         
         logger.info(f"成功获取统计数据: Pages项目={len(self.current_data['pages'])}, Workers={len(self.current_data['workers'])}")
     
     def update_history(self) -> None:
         """更新历史数据"""
-        today = datetime.now().strftime("%Y-%m-%d")
-        
-        for project, requests in self.current_data["pages"].items():
-            if project not in self.history_data["pages"]:
-                self.history_data["pages"][project] = {}
-            self.history_data["pages"][project][today] = requests
-        
-        for worker, requests in self.current_data["workers"].items():
-            if worker not in self.history_data["workers"]:
-                self.history_data["workers"][worker] = {}
-            self.history_data["workers"][worker][today] = requests
-        
+        today = self.today
         storage_days = int(os.getenv("HISTORY_STORAGE_DAYS", 30))
-        cutoff_date = (datetime.now() - timedelta(days=storage_days)).strftime("%Y-%m-%d")
-        
-        for project in list(self.history_data["pages"].keys()):
-            self.history_data["pages"][project] = {date: req for date, req in self.history_data["pages"][project].items() if date >= cutoff_date}
-            if not self.history_data["pages"][project]:
-                del self.history_data["pages"][project]
+        cutoff_date = (self.run_time - timedelta(days=storage_days)).strftime("%Y-%m-%d")
         
-        for worker in list(self.history_data["workers"].keys()):
-            self.history_data["workers"][worker] = {date: req for date, req in self.history_data["workers"][worker].items() if date >= cutoff_date}
-            if not self.history_data["workers"][worker]:
-                del self.history_data["workers"][worker]
+        for kind in ("pages", "workers"):
+            section = self.history_data[kind]
+            dates = section["dates"]
+            series = section["series"]
+            
+            # 每个日期占一列；同一天多次运行时覆盖当天的数据。
+            # 按二分位置插入，已有更晚的日期（时区或时钟偏差）时日期仍保持有序
+            column = bisect_left(dates, today)
+            if column == len(dates) or dates[column] != today:
+                dates.insert(column, today)
+                for values in series.values():
+                    values.insert(column, None)
+            for name, requests in self.current_data[kind].items():
+                series.setdefault(name, [None] * len(dates))[column] = requests
+            
+            # 日期按时间顺序排列，二分定位过期列后原地删除前缀，不再复制列表
+            expired = bisect_left(dates, cutoff_date)
+            if expired:
+                del dates[:expired]
+                for name in list(series):
+                    values = series[name]
+                    del values[:expired]
+                    if all(value is None for value in values):
+                        del series[name]
         
         self._save_history()
     
+    @staticmethod
+    def _change_percents(current: Dict[str, int], history: Dict[str, Any],
+                         date: str) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """批量计算当前请求量相对指定日期的变化百分比，返回 (名称, 基准请求量, 变化百分比)，只包含基准请求量大于 0 的项"""
+        dates = history["dates"]
+        column = bisect_left(dates, date)
+        if column == len(dates) or dates[column] != date:
+            return [], np.empty(0), np.empty(0)
+        
+        # 先筛掉没有基准数据或基准为 0 的项，之后的向量运算无需再做掩码处理
+        series = history["series"]
+        names = [name for name in current if name in series and (series[name][column] or 0) > 0]
+        current_arr = np.fromiter((current[name] for name in names), dtype=np.float64, count=len(names))
+        previous_arr = np.fromiter((series[name][column] for name in names), dtype=np.float64, count=len(names))
+        change = (current_arr - previous_arr) / previous_arr * 100
+        return names, previous_arr, change
+    
+    def _check_series(self, label: str, current: Dict[str, int], history: Dict[str, Any],
+                      increase_threshold: int, decrease_threshold: int) -> List[str]:
+        """检查一类服务（Pages 或 Workers）的请求量变化"""
+        alerts = []
+        names, previous, change = self._change_percents(current, history, self.yesterday)
+        increase = change >= increase_threshold
+        decrease = change <= -decrease_threshold
+        for i in np.flatnonzero(increase | decrease):
+            name = _escape_markdown(names[i])
+            detail = f"昨日: {int(previous[i]):,} → 今日: {current[names[i]]:,}"
+            if increase[i]:
+                alerts.append(f"📈 警告: {label} '{name}' 请求量增长异常 ({change[i]:.1f}%)\n{detail}")
+            if decrease[i]:
+                alerts.append(f"📉 警告: {label} '{name}' 请求量下降异常 ({abs(change[i]):.1f}%)\n{detail}")
+        return alerts
+    
     def check_thresholds(self) -> List[str]:
         """检查阈值并生成警报"""
         alerts = []
-        today = datetime.now().strftime("%Y-%m-%d")
-        yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-        
-        for project, requests in self.current_data["pages"].items():
-            if project in self.history_data["pages"] and yesterday in self.history_data["pages"][project]:
-                yesterday_requests = self.history_data["pages"][project][yesterday]
-                if yesterday_requests > 0:
-                    change_percent = ((requests - yesterday_requests) / yesterday_requests) * 100
-                    if change_percent >= self.thresholds["pages_request_increase"]:
-                        alerts.append(f"📈 警告: Pages项目 '{project}' 请求量增长异常 ({change_percent:.1f}%)\n"
-                                     f"昨日: {yesterday_requests:,} → 今日: {requests:,}")
-                    if change_percent <= -self.thresholds["pages_request_decrease"]:
-                        alerts.append(f"📉 警告: Pages项目 '{project}' 请求量下降异常 ({abs(change_percent):.1f}%)\n"
-                                     f"昨日: {yesterday_requests:,} → 今日: {requests:,}")
-        
-        for worker, requests in self.current_data["workers"].items():
-            if worker in self.history_data["workers"] and yesterday in self.history_data["workers"][worker]:
-                yesterday_requests = self.history_data["workers"][worker][yesterday]
-                if yesterday_requests > 0:
-                    change_percent = ((requests - yesterday_requests) / yesterday_requests) * 100
-                    if change_percent >= self.thresholds["workers_request_increase"]:
-                        alerts.append(f"📈 警告: Workers服务 '{worker}' 请求量增长异常 ({change_percent:.1f}%)\n"
-                                     f"昨日: {yesterday_requests:,} → 今日: {requests:,}")
-                    if change_percent <= -self.thresholds["workers_request_decrease"]:
-                        alerts.append(f"📉 警告: Workers服务 '{worker}' 请求量下降异常 ({abs(change_percent):.1f}%)\n"
-                                     f"昨日: {yesterday_requests:,} → 今日: {requests:,}")
-        
+        for kind, label in (("pages", "Pages项目"), ("workers", "Workers服务")):
+            alerts.extend(self._check_series(
+                label,
+                self.current_data[kind],
+                self.history_data[kind],
+                self.thresholds[f"{kind}_request_increase"],
+                self.thresholds[f"{kind}_request_decrease"]
+            ))
         return alerts
     
     def generate_charts(self) -> List[str]:
         """生成趋势图表"""
-        charts = []
-        plt.rcParams["font.family"] = ["SimHei", "WenQuanYi Micro Hei", "Heiti TC"]
-        plt.rcParams["axes.unicode_minus"] = False
-        
-        if self.history_data["pages"]:
-            plt.figure(figsize=(12, 6))
-            for project, data in self.history_data["pages"].items():
-                if len(data) > 1:
-                    dates = sorted(data.keys())
-                    requests = [data[date] for date in dates]
-                    plt.plot(dates, requests, marker='o', label=project)
-            plt.title("Cloudflare Pages 项目请求量趋势")
-            plt.xlabel("日期")
-            plt.ylabel("请求量")
-            plt.grid(True)
-            plt.legend()
-            plt.xticks(rotation=45)
-            plt.tight_layout()
-            chart_path = "pages_trend.png"
-            plt.savefig(chart_path)
-            plt.close()
-            charts.append(chart_path)
-        
-        if self.history_data["workers"]:
-            plt.figure(figsize=(12, 6))
-            for worker, data in self.history_data["workers"].items():
-                if len(data) > 1:
-                    dates = sorted(data.keys())
-                    requests = [data[date] for date in dates]
-                    plt.plot(dates, requests, marker='o', label=worker)
-            plt.title("Cloudflare Workers 服务请求量趋势")
-            plt.xlabel("日期")
-            plt.ylabel("请求量")
-            plt.grid(True)
-            plt.legend()
-            plt.xticks(rotation=45)
-            plt.tight_layout()
-            chart_path = "workers_trend.png"
-            plt.savefig(chart_path)
-            plt.close()
-            charts.append(chart_path)
-        
-        return charts
+        return render_trend_charts(self.history_data)
     
     def generate_report(self) -> str:
         """生成统计报告文本"""
-        report = "📊 *Cloudflare 统计报告*\n\n"
-        report += f"📅 统计日期: {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}\n\n"
+        parts = [
+            "📊 *Cloudflare 统计报告*\n\n",
+            f"📅 统计日期: {self.run_time.strftime('%Y年%m月%d日 %H:%M:%S')}\n\n"
+        ]
         
         if self.current_data["pages"]:
-            report += "### 📄 Pages 项目请求量\n"
-            for project, requests in sorted(self.current_data["pages"].items()):
-                report += f"- *{project}*: {requests:,} 请求\n"
-            report += "\n"
+            parts.append("### 📄 Pages 项目请求量\n")
+            parts.extend(f"- *{project}*: {requests:,} 请求\n"
+                         for project, requests in sorted(self.current_data["pages"].items()))
+            parts.append("\n")
         
         if self.current_data["workers"]:
-            report += "### 💻 Workers 服务请求量\n"
-            for worker, requests in sorted(self.current_data["workers"].items()):
-                report += f"- *{worker}*: {requests:,} 请求\n"
-            report += "\n"
+            parts.append("### 💻 Workers 服务请求量\n")
+            parts.extend(f"- *{worker}*: {requests:,} 请求\n"
+                         for worker, requests in sorted(self.current_data["workers"].items()))
+            parts.append("\n")
         
-        report += "🔄 数据每24小时更新一次\n"
-        report += "📈 图表展示最近7天趋势"
-        return report
+        parts.append("🔄 数据每24小时更新一次\n")
+        parts.append("📈 图表展示最近7天趋势")
+        return "".join(parts)
+    
+    def _uploadable_photos(self, photos: List[Tuple[str, str]], charts: List[str]) -> List[Tuple[str, str]]:
+        """筛选出已成功渲染且大小符合 Telegram 限制的图表"""
+        return [photo for photo in photos if photo[0] in charts and self.tg_bot.can_upload(photo[0])]
+    
+    def _render_charts(self) -> List[str]:
+        """渲染趋势图，渲染失败时视为没有图表，不影响报告和警报的发送"""
+        try:
+            return self.generate_charts()
+        except Exception as e:
+            logger.error(f"生成图表失败: {str(e)}")
+            return []
     
     def send_report(self) -> None:
         """发送报告和图表"""
         report = self.generate_report()
-        success = self.tg_bot.send_message(report)
-        if not success:
+        alerts = self.check_thresholds()
+        photos = [(chart_path, caption) for kind, _, chart_path, caption in CHART_SPECS
+                  if self.history_data[kind]["series"]]
+        photos = self._uploadable_photos(photos, self._render_charts()) if photos else []
+        
+        # 报告较短时直接作为第一张图表的说明，与图表一起发送，省去单独的 sendMessage 请求；
+        # 图表发送失败时退回单独发送报告文本，之后仍会尝试以原说明再发送图表
+        success = False
+        if photos and self.tg_bot.fits_caption(f"{report}\n\n{photos[0][1]}"):
+            chart_path, caption = photos[0]
+            photos[0] = (chart_path, f"{report}\n\n{caption}")
+            success = self.tg_bot.send_photos(photos)
+            if success:
+                photos = []
+            else:
+                logger.warning("带报告说明的图表发送失败，改为单独发送报告文本")
+                photos[0] = (chart_path, caption)
+        if not success and not self.tg_bot.send_message(report):
             logger.error("发送报告文本失败")
-            return
         
-        alerts = self.check_thresholds()
+        # 警报不依赖报告和图表是否发送成功
         if alerts:
             alert_message = "\n\n⚠️ *异常情况警报* ⚠️\n\n" + "\n\n".join(alerts)
             self.tg_bot.send_message(alert_message)
         
-        charts = self.generate_charts()
-        for chart in charts:
-            if "pages" in chart:
-                caption = "📄 Cloudflare Pages 项目请求量趋势图"
-            else:
-                caption = "💻 Cloudflare Workers 服务请求量趋势图"
-            self.tg_bot.send_photo(chart, caption)
+        self.tg_bot.send_photos(photos)
 
 def main():
     try:
-        tracker = CloudflareStatsTracker()
-        tracker.fetch_stats()
-        tracker.update_history()
-        tracker.send_report()
+        with CloudflareStatsTracker() as tracker:
+            tracker.fetch_stats()
+            tracker.update_history()
+            tracker.send_report()
         logger.info("统计数据获取和推送完成")
     except Exception as e:
         logger.exception(f"执行过程中发生错误: {str(e)}")
@@ -2,8 +2,33 @@ import unittest
 from unittest.mock import patch, MagicMock
 import json
 import os
+import tempfile
+import time
+import requests
 from datetime import datetime, timedelta
-from src.fetch_cloudflare_stats import CloudflareStatsTracker
+from src.fetch_cloudflare_stats import CloudflareAPI, CloudflareStatsTracker, TelegramBot
+
+def _mock_response(payload=None, status_code=200, headers=None):
+    """构造 CloudflareAPI._request 使用的模拟响应"""
+    response = MagicMock()
+    response.status_code = status_code
+    response.content = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    response.headers = headers or {}
+    return response
+
+def _route_requests(routes):
+    """按 URL 后缀返回对应的模拟响应，供 session.request 使用"""
+    def request(method, url, **kwargs):
+        for suffix, response in routes.items():
+            if url.endswith(suffix):
+                if isinstance(response, Exception):
+                    raise response
+                return response
+        raise AssertionError(f"意外的请求: {method} {url}")
+    return request
+
+def _graphql_payload(groups):
+    return {"data": {"viewer": {"accounts": [{"workersInvocationsAdaptive": groups}]}}, "errors": None}
 
 class TestCloudflareStatsTracker(unittest.TestCase):
     def setUp(self):
@@ -40,7 +65,11 @@ class TestCloudflareStatsTracker(unittest.TestCase):
         if os.path.exists(self.config["history"]["data_file"]):
             os.remove(self.config["history"]["data_file"])
         
-        self.tracker = CloudflareStatsTracker("tests/config_test.json")
+        # 历史数据写入临时目录，避免测试改动工作目录下真实的 history/
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        with patch.dict(os.environ, {"HISTORY_FILE": os.path.join(tmp_dir.name, "history.json")}):
+            self.tracker = CloudflareStatsTracker("tests/config_test.json")
     
     def tearDown(self):
         # 清理临时文件
@@ -128,10 +157,12 @@ class TestCloudflareStatsTracker(unittest.TestCase):
         yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
         self.tracker.history_data = {
             'pages': {
-                yesterday: {'project1': 700, 'project2': 2000}
+                'dates': [yesterday],
+                'series': {'project1': [700], 'project2': [2000]}
             },
             'workers': {
-                yesterday: {'service1': 500, 'service2': 1000}
+                'dates': [yesterday],
+                'series': {'service1': [500], 'service2': [1000]}
             }
         }
         
@@ -154,10 +185,12 @@ class TestCloudflareStatsTracker(unittest.TestCase):
         yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
         self.tracker.history_data = {
             'pages': {
-                yesterday: {'project1': 1500, 'project2': 2000}
+                'dates': [yesterday],
+                'series': {'project1': [1500], 'project2': [2000]}
             },
             'workers': {
-                yesterday: {'service1': 800, 'service2': 1500}
+                'dates': [yesterday],
+                'series': {'service1': [800], 'service2': [1500]}
             }
         }
         
@@ -189,27 +222,143 @@ class TestCloudflareStatsTracker(unittest.TestCase):
         # 验证结果
         self.assertIn('pages', self.tracker.history_data)
         self.assertIn('workers', self.tracker.history_data)
-        self.assertIn(today, self.tracker.history_data['pages'])
-        self.assertIn(today, self.tracker.history_data['workers'])
-        self.assertEqual(self.tracker.history_data['pages'][today], self.tracker.current_data['pages'])
-        self.assertEqual(self.tracker.history_data['workers'][today], self.tracker.current_data['workers'])
+        self.assertEqual(self.tracker.history_data['pages']['dates'][-1], today)
+        self.assertEqual(self.tracker.history_data['workers']['dates'][-1], today)
+        for kind in ('pages', 'workers'):
+            series = self.tracker.history_data[kind]['series']
+            for name, requests in self.tracker.current_data[kind].items():
+                self.assertEqual(series[name][-1], requests)
+    
+    def test_update_history_keeps_dates_sorted(self):
+        # 历史中已有比今天更晚的日期（例如在其他时区写入）
+        today = self.tracker.today
+        yesterday = self.tracker.yesterday
+        tomorrow = (self.tracker.run_time + timedelta(days=1)).strftime("%Y-%m-%d")
+        self.tracker.history_data = {
+            'pages': {'dates': [yesterday, tomorrow], 'series': {'project1': [700, 900]}},
+            'workers': {'dates': [], 'series': {}}
+        }
+        self.tracker.current_data = {'pages': {'project1': 1000}, 'workers': {}}
+        
+        # 执行测试
+        self.tracker.update_history()
+        
+        # 验证结果：今天的数据插入到有序位置，昨天的列仍可用于阈值检查
+        self.assertEqual(self.tracker.history_data['pages']['dates'], [yesterday, today, tomorrow])
+        self.assertEqual(self.tracker.history_data['pages']['series']['project1'], [700, 1000, 900])
+        alerts = self.tracker.check_thresholds()
+        self.assertEqual(len(alerts), 1)
+        self.assertIn("'project1' 请求量增长异常", alerts[0])
+    
+    def test_save_history_removes_tmp_file_on_failure(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tracker.history_file = os.path.join(tmp_dir.name, "history.json")
+        self.tracker._history_digest = None
+        
+        # 执行测试：写入后同步磁盘失败
+        with patch('os.fsync', side_effect=OSError("disk error")):
+            self.tracker._save_history()
+        
+        # 验证结果
+        self.assertEqual(os.listdir(tmp_dir.name), [])
+    
+    def test_load_history_migrates_legacy_schema(self):
+        # 旧版按项目存储的历史文件
+        legacy = {
+            'pages': {'project1': {'2024-01-01': 100, '2024-01-02': 200}, 'project2': {'2024-01-02': 50}},
+            'workers': {}
+        }
+        with open(self.config["history"]["data_file"], "w") as f:
+            json.dump(legacy, f)
+        
+        # 执行测试
+        with patch.dict(os.environ, {"HISTORY_FILE": self.config["history"]["data_file"]}):
+            tracker = CloudflareStatsTracker("tests/config_test.json")
+        
+        # 验证结果
+        self.assertEqual(tracker.history_data['pages'], {
+            'dates': ['2024-01-01', '2024-01-02'],
+            'series': {'project1': [100, 200], 'project2': [None, 50]}
+        })
+        self.assertEqual(tracker.history_data['workers'], {'dates': [], 'series': {}})
+    
+    def _stub_fetch(self, routes):
+        """替换 Cloudflare 会话的请求方法，并关闭磁盘缓存"""
+        self.tracker.cf_api.cache_dir = None
+        self.tracker.cf_api.session = MagicMock()
+        self.tracker.cf_api.session.request.side_effect = _route_requests(routes)
+    
+    def test_fetch_stats_uses_graphql_workers_requests(self):
+        self._stub_fetch({
+            '/pages/projects': _mock_response({'result': []}),
+            '/workers/scripts': _mock_response({'result': [{'name': 'service1'}, {'name': 'service2'}]}),
+            '/graphql': _mock_response(_graphql_payload([
+                {'sum': {'requests': 500}, 'dimensions': {'scriptName': 'service1'}}
+            ])),
+        })
+        
+        # 执行测试
+        self.tracker.fetch_stats()
+        
+        # 验证结果：查询结果中没有的 Worker 记为 0，且不再逐个请求 REST 接口
+        self.assertEqual(self.tracker.current_data['workers'], {'service1': 500, 'service2': 0})
+        urls = [call.args[1] for call in self.tracker.cf_api.session.request.call_args_list]
+        self.assertFalse(any(url.endswith('/workers/analytics/dashboard') for url in urls))
+    
+    def test_fetch_stats_uses_worker_id_as_name(self):
+        # /workers/scripts 返回的条目只有 id 字段
+        self._stub_fetch({
+            '/pages/projects': _mock_response({'result': []}),
+            '/workers/scripts': _mock_response({'result': [{'id': 'service1'}, {'created_on': '2024-01-01'}]}),
+            '/graphql': _mock_response(_graphql_payload([
+                {'sum': {'requests': 500}, 'dimensions': {'scriptName': 'service1'}}
+            ])),
+        })
+        
+        # 执行测试
+        self.tracker.fetch_stats()
+        
+        # 验证结果：按 id 匹配查询结果，没有名称的条目直接跳过
+        self.assertEqual(self.tracker.current_data['workers'], {'service1': 500})
     
-    @patch('matplotlib.pyplot.savefig')
-    @patch('matplotlib.pyplot.close')
-    @patch('matplotlib.pyplot.figure')
-    def test_generate_charts(self, mock_figure, mock_close, mock_savefig):
+    def test_fetch_stats_falls_back_to_rest_workers_metrics(self):
+        self._stub_fetch({
+            '/pages/projects': _mock_response({'result': []}),
+            '/workers/scripts': _mock_response({'result': [{'name': 'service1'}, {'name': 'service2'}]}),
+            '/graphql': _mock_response({'data': None, 'errors': [{'message': 'not authorized'}]}),
+            '/workers/analytics/dashboard': _mock_response({'result': {'script': {'requests': 700}}}),
+        })
+        
+        # 执行测试
+        self.tracker.fetch_stats()
+        
+        # 验证结果：GraphQL 查询失败时逐个请求每个 Worker 的指标
+        self.assertEqual(self.tracker.current_data['workers'], {'service1': 700, 'service2': 700})
+        scripts = [call.kwargs['params']['script_name']
+                   for call in self.tracker.cf_api.session.request.call_args_list
+                   if call.args[1].endswith('/workers/analytics/dashboard')]
+        self.assertCountEqual(scripts, ['service1', 'service2'])
+    
+    def test_generate_charts(self):
+        # 图表写入当前目录，切换到临时目录中实际渲染
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+        
         # 设置历史数据
         today = datetime.now().strftime("%Y-%m-%d")
         yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
         
         self.tracker.history_data = {
             'pages': {
-                yesterday: {'project1': 800, 'project2': 1800},
-                today: {'project1': 1000, 'project2': 2000}
+                'dates': [yesterday, today],
+                'series': {'project1': [800, 1000], 'project2': [1800, 2000]}
             },
             'workers': {
-                yesterday: {'service1': 400, 'service2': 1400},
-                today: {'service1': 500, 'service2': 1500}
+                'dates': [yesterday, today],
+                'series': {'service1': [400, 500], 'service2': [1400, 1500]}
             }
         }
         
@@ -220,6 +369,8 @@ class TestCloudflareStatsTracker(unittest.TestCase):
         self.assertEqual(len(charts), 2)
         self.assertIn('pages_trend.png', charts)
         self.assertIn('workers_trend.png', charts)
+        for chart in charts:
+            self.assertGreater(os.path.getsize(os.path.join(tmp_dir.name, chart)), 0)
     
     @patch('requests.post')
     def test_send_telegram_message(self, mock_post):
@@ -235,6 +386,59 @@ class TestCloudflareStatsTracker(unittest.TestCase):
         self.assertTrue(result)
         mock_post.assert_called_once()
     
+    def test_split_long_message(self):
+        # 超长报告按行拆分，每段不超过 Telegram 的消息长度上限
+        message = "\n".join(f"- *project{i}*: {i:,} 请求" for i in range(1000))
+        chunks = TelegramBot.split_message(message)
+        
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("\n".join(chunks), message)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk.encode('utf-16-le')) // 2, TelegramBot.MESSAGE_LIMIT)
+    
+    def _stub_send_report(self, send_photos_result):
+        """准备会触发警报的数据，并替换图表渲染和 Telegram 客户端"""
+        yesterday = self.tracker.yesterday
+        self.tracker.history_data = {
+            'pages': {'dates': [yesterday], 'series': {'project1': [100]}},
+            'workers': {'dates': [yesterday], 'series': {'service1': [100]}}
+        }
+        self.tracker.current_data = {'pages': {'project1': 1000}, 'workers': {'service1': 100}}
+        self.tracker._render_charts = lambda: ['pages_trend.png', 'workers_trend.png']
+        self.tracker.tg_bot = MagicMock()
+        self.tracker.tg_bot.fits_caption.side_effect = TelegramBot.fits_caption
+        self.tracker.tg_bot.can_upload.return_value = True
+        self.tracker.tg_bot.send_photos.return_value = send_photos_result
+        self.tracker.tg_bot.send_message.return_value = True
+        return self.tracker.tg_bot
+    
+    def test_send_report_merges_report_into_caption(self):
+        tg_bot = self._stub_send_report(send_photos_result=True)
+        
+        # 执行测试
+        self.tracker.send_report()
+        
+        # 验证结果：报告作为第一张图表的说明随相册发送，警报单独发送
+        photos = tg_bot.send_photos.call_args_list[0].args[0]
+        self.assertEqual([path for path, _ in photos], ['pages_trend.png', 'workers_trend.png'])
+        self.assertIn("📊 *Cloudflare 统计报告*", photos[0][1])
+        self.assertEqual(len(tg_bot.send_message.call_args_list), 1)
+        self.assertIn("异常情况警报", tg_bot.send_message.call_args.args[0])
+    
+    def test_send_report_falls_back_when_album_fails(self):
+        tg_bot = self._stub_send_report(send_photos_result=False)
+        
+        # 执行测试
+        self.tracker.send_report()
+        
+        # 验证结果：相册发送失败时单独发送报告，警报照常发送，图表以原说明重试
+        messages = [call.args[0] for call in tg_bot.send_message.call_args_list]
+        self.assertEqual(len(messages), 2)
+        self.assertIn("📊 *Cloudflare 统计报告*", messages[0])
+        self.assertIn("Pages项目 'project1' 请求量增长异常", messages[1])
+        retried = tg_bot.send_photos.call_args_list[-1].args[0]
+        self.assertEqual(retried[0], ('pages_trend.png', "📄 Cloudflare Pages 项目请求量趋势图"))
+    
     def test_generate_report(self):
         # 设置当前数据
         self.tracker.current_data = {
@@ -254,5 +458,100 @@ class TestCloudflareStatsTracker(unittest.TestCase):
         self.assertIn("- service1: 500 请求", report)
         self.assertIn("- service2: 1,500 请求", report)
 
+class TestCloudflareAPI(unittest.TestCase):
+    def setUp(self):
+        self.api = CloudflareAPI("test_account_id", "test_api_token")
+        self.api.session = MagicMock()
+    
+    def test_fetch_all_workers_requests_sums_groups(self):
+        self.api.session.request.return_value = _mock_response(_graphql_payload([
+            {'sum': {'requests': 300}, 'dimensions': {'scriptName': 'service1'}},
+            {'sum': {'requests': 200}, 'dimensions': {'scriptName': 'service1'}},
+            {'sum': {'requests': 50}, 'dimensions': {'scriptName': 'service2'}}
+        ]))
+        
+        # 执行测试
+        result = self.api.fetch_all_workers_requests("2024-01-01T00:00:00Z", "2024-01-02T00:00:00Z")
+        
+        # 验证结果：同一 Worker 的多个分组累加
+        self.assertEqual(result, {'service1': 500, 'service2': 50})
+        call = self.api.session.request.call_args
+        self.assertEqual(call.args[0], "POST")
+        self.assertEqual(call.kwargs['json']['variables']['accountTag'], "test_account_id")
+    
+    def test_fetch_all_workers_requests_returns_none_on_errors(self):
+        for payload in ({'data': None, 'errors': [{'message': 'not authorized'}]},
+                        {'data': {'viewer': {'accounts': []}}, 'errors': None}):
+            self.api.session.request.return_value = _mock_response(payload)
+            
+            # 执行测试并验证结果
+            self.assertIsNone(self.api.fetch_all_workers_requests("2024-01-01T00:00:00Z", "2024-01-02T00:00:00Z"))
+
+    def _use_cache_dir(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.api.cache_dir = tmp_dir.name
+    
+    def _expire_cache(self, cache_key):
+        """让磁盘缓存过期，并清空本次运行内的响应复用"""
+        os.utime(self.api._cache_path(cache_key), (0, 0))
+        self.api._memo.clear()
+    
+    def test_request_uses_fresh_disk_cache(self):
+        self._use_cache_dir()
+        self.api.session.request.return_value = _mock_response({'result': [{'name': 'service1'}]},
+                                                               headers={'ETag': '"v1"'})
+        self.assertEqual(self.api.fetch_workers(), [{'name': 'service1'}])
+        self.api._memo.clear()
+        
+        # 执行测试：缓存未过期时不发送请求
+        result = self.api.fetch_workers()
+        
+        # 验证结果
+        self.assertEqual(result, [{'name': 'service1'}])
+        self.api.session.request.assert_called_once()
+        self.assertNotIn('If-None-Match', self.api.session.request.call_args.kwargs['headers'])
+    
+    def test_request_revalidates_expired_cache_with_etag(self):
+        self._use_cache_dir()
+        self.api.session.request.return_value = _mock_response({'result': [{'name': 'service1'}]},
+                                                               headers={'ETag': '"v1"'})
+        self.api.fetch_workers()
+        self._expire_cache("workers")
+        self.api.session.request.return_value = _mock_response(status_code=304)
+        
+        # 执行测试
+        result = self.api.fetch_workers()
+        
+        # 验证结果：带上 ETag 重新验证，304 时沿用缓存内容并刷新有效期
+        self.assertEqual(result, [{'name': 'service1'}])
+        self.assertEqual(self.api.session.request.call_args.kwargs['headers']['If-None-Match'], '"v1"')
+        self.assertGreater(os.path.getmtime(self.api._cache_path("workers")), time.time() - 60)
+    
+    def test_request_304_without_cache_raises(self):
+        self._use_cache_dir()
+        cache_path = self.api._cache_path("workers")
+        with open(f"{cache_path}.etag", "w") as f:
+            f.write('"v1"')
+        self.api.session.request.return_value = _mock_response(status_code=304)
+        
+        # 执行测试并验证结果：只有 ETag 没有缓存内容时无法使用 304 响应
+        with self.assertRaises(ValueError):
+            self.api._request(self.api.workers_url, cache_key="workers", ttl=60)
+        self.assertEqual(self.api.fetch_workers(), [])
+    
+    def test_fetch_workers_falls_back_to_stale_cache(self):
+        self._use_cache_dir()
+        self.api.session.request.return_value = _mock_response({'result': [{'name': 'service1'}]})
+        self.api.fetch_workers()
+        self._expire_cache("workers")
+        self.api.session.request.side_effect = requests.ConnectionError("network down")
+        
+        # 执行测试
+        result = self.api.fetch_workers()
+        
+        # 验证结果：请求失败时退回过期的缓存
+        self.assertEqual(result, [{'name': 'service1'}])
+
 if __name__ == '__main__':
     unittest.main()  
\ No newline at end of file